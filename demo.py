@@ -22,12 +22,15 @@ Orchestration agent: decides which agent to run based on the current state of th
 from dotenv import load_dotenv
 load_dotenv()
 
+import asyncio
 from enum import Enum
 from typing import List
-import pprint
-from colorama import Fore, Back, Style
+import json
+import httpx
+from colorama import Fore, Style
 
-from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory import BaseMemory, ChatSummaryMemoryBuffer
 from llama_index.core.tools import FunctionTool
 from llama_index.llms.openai import OpenAI 
 from llama_index.agent.openai import OpenAIAgent
@@ -39,10 +42,21 @@ class Speaker(str, Enum):
     ACCOUNT_BALANCE = "account_balance"
     TRANSFER_MONEY = "transfer_money"
     CONCIERGE = "concierge"
-    ORCHESTRATOR = "orchestrator"
+
+# One pooled HTTP client for every OpenAI call, so connections stay open between
+# turns instead of each LLM wrapper opening its own.
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+
+# Shared LLMs: agents reuse these clients and their HTTP connections instead of
+# each building its own. The orchestration and continuation agents use meta_llm.
+llm = OpenAI(model="gpt-4o", async_http_client=http_client)
+meta_llm = OpenAI(model="gpt-4o",temperature=0.4, async_http_client=http_client)
 
 # Stock lookup agent
-def stock_lookup_agent_factory(state: dict) -> OpenAIAgent:
+def stock_lookup_agent_factory(state: dict, memory: BaseMemory) -> OpenAIAgent:
     
     def lookup_stock_price(stock_symbol: str) -> str:
         """Useful for looking up a stock price."""
@@ -66,25 +80,25 @@ def stock_lookup_agent_factory(state: dict) -> OpenAIAgent:
         FunctionTool.from_defaults(fn=done),
     ]
 
-    system_prompt = (f"""
+    system_prompt = ("""
         You are a helpful assistant that is looking up stock prices.
         The user may not know the stock symbol of the company they're interested in,
         so you can help them look it up by the name of the company.
         You can only look up stock symbols given to you by the search_for_stock_symbol tool, don't make them up. Trust the output of the search_for_stock_symbol tool even if it doesn't make sense to you.
-        The current user state is:
-        {pprint.pformat(state, indent=4)}
+        The current user state is in the most recent state update in the chat history.
         Once you have supplied a stock price, you must call the tool "done" to signal that you are done.
         If the user asks to do anything other than look up a stock symbol or price, call the tool "done" to signal some other agent should help.
     """)
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-4o"),
+        llm=llm,
+        memory=memory,
         system_prompt=system_prompt,
     )
 
 # Auth Agent
-def auth_agent_factory(state: dict) -> OpenAIAgent:
+def auth_agent_factory(state: dict, memory: BaseMemory) -> OpenAIAgent:
 
     def store_username(username: str) -> None:
         """Adds the username to the user state."""
@@ -117,25 +131,25 @@ def auth_agent_factory(state: dict) -> OpenAIAgent:
         FunctionTool.from_defaults(fn=done),
     ]
 
-    system_prompt = (f"""
+    system_prompt = ("""
         You are a helpful assistant that is authenticating a user.
         Your task is to get a valid session token stored in the user state.
         To do this, the user must supply you with a username and a valid password. You can ask them to supply these.
         If the user supplies a username and password, call the tool "login" to log them in.
-        The current user state is:
-        {pprint.pformat(state, indent=4)}
+        The current user state is in the most recent state update in the chat history.
         When you have authenticated, call the tool "done" to signal that you are done.
         If the user asks to do anything other than authenticate, call the tool "done" to signal some other agent should help.
     """)
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-4o"),
+        llm=llm,
+        memory=memory,
         system_prompt=system_prompt,
     )
 
 # Account balance agent
-def account_balance_agent_factory(state: dict) -> OpenAIAgent:
+def account_balance_agent_factory(state: dict, memory: BaseMemory) -> OpenAIAgent:
 
     def get_account_id(account_name: str) -> str:
         """Useful for looking up an account ID."""
@@ -169,26 +183,26 @@ def account_balance_agent_factory(state: dict) -> OpenAIAgent:
         FunctionTool.from_defaults(fn=done),
     ]
 
-    system_prompt = (f"""
+    system_prompt = ("""
         You are a helpful assistant that is looking up account balances.
         The user may not know the account ID of the account they're interested in,
         so you can help them look it up by the name of the account.
         The user can only do this if they are authenticated, which you can check with the is_authenticated tool.
         If they aren't authenticated, tell them to authenticate
         If they're trying to transfer money, they have to check their account balance first, which you can help with.
-        The current user state is:
-        {pprint.pformat(state, indent=4)}
+        The current user state is in the most recent state update in the chat history.
         Once you have supplied an account balance, you must call the tool "done" to signal that you are done.
         If the user asks to do anything other than look up an account balance, call the tool "done" to signal some other agent should help.
     """)
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-4o"),
+        llm=llm,
+        memory=memory,
         system_prompt=system_prompt,
     )
 
-def transfer_money_agent_factory(state: dict) -> OpenAIAgent:
+def transfer_money_agent_factory(state: dict, memory: BaseMemory) -> OpenAIAgent:
     
     def transfer_money(from_account_id: str, to_account_id: str, amount: int) -> None:
         """Useful for transferring money between accounts."""
@@ -228,36 +242,32 @@ def transfer_money_agent_factory(state: dict) -> OpenAIAgent:
         FunctionTool.from_defaults(fn=done),
     ]
 
-    system_prompt = (f"""
+    system_prompt = ("""
         You are a helpful assistant that transfers money between accounts.
         The user can only do this if they are authenticated, which you can check with the is_authenticated tool.
         If they aren't authenticated, tell them to authenticate first.
         The user must also have looked up their account balance already, which you can check with the has_balance tool.
         If they haven't already, tell them to look up their account balance first.
-        The current user state is:
-        {pprint.pformat(state, indent=4)}
+        The current user state is in the most recent state update in the chat history.
         Once you have transferred the money, you can call the tool "done" to signal that you are done.
         If the user asks to do anything other than transfer money, call the tool "done" to signal some other agent should help.
     """)
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-4o"),
+        llm=llm,
+        memory=memory,
         system_prompt=system_prompt,
     )
 
 # Concierge agent
-def concierge_agent_factory(state: dict) -> OpenAIAgent:
-
-    def dummy_tool() -> bool:
-        """A tool that does nothing."""
-        print("Doing nothing.")
+def concierge_agent_factory(state: dict, memory: BaseMemory) -> OpenAIAgent:
 
-    tools = [
-        FunctionTool.from_defaults(fn=dummy_tool)
-    ]
+    # the concierge only talks to the user, so it gets no tools; an empty tool
+    # list keeps tool schemas out of its requests entirely
+    tools = []
 
-    system_prompt = (f"""
+    system_prompt = ("""
         You are a helpful assistant that is helping a user navigate a financial system.
         Your job is to ask the user questions to figure out what they want to do, and give them the available things they can do.
         That includes
@@ -265,86 +275,130 @@ def concierge_agent_factory(state: dict) -> OpenAIAgent:
         * authenticating the user
         * checking an account balance (requires authentication first)
         * transferring money between accounts (requires authentication and checking an account balance first)
-
-        The current state of the user is:
-        {pprint.pformat(state, indent=4)}
+        The current user state is in the most recent state update in the chat history.
     """)
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-4o"),
+        llm=llm,
+        memory=memory,
         system_prompt=system_prompt,
     )
 
-# Continuation agent
-def continuation_agent_factory(state: dict) -> OpenAIAgent:
-    
-    def dummy_tool() -> bool:
-        """A tool that does nothing."""
-        print("Doing nothing.")
-
-    tools = [
-        FunctionTool.from_defaults(fn=dummy_tool)
+def text_messages(chat_history: List[ChatMessage]) -> List[ChatMessage]:
+    """Copies the plain-text turns of a chat history, leaving out tool calls and their results."""
+    return [
+        ChatMessage(role=message.role, content=message.content)
+        for message in chat_history
+        if message.role in (MessageRole.SYSTEM, MessageRole.USER, MessageRole.ASSISTANT) and message.content
     ]
 
-    system_prompt = (f"""
-        The current state of the user is:
-        {pprint.pformat(state, indent=4)}
+# Continuation agent
+async def continue_task(chat_history: List[ChatMessage]) -> str:
+    """Works out whether the user's original task has more to do, with a single LLM call."""
+
+    system_prompt = ("""
+        You decide what the user still wants to do, based on the chat history.
+        The current user state is in the most recent state update in the chat history.
     """)
 
-    return OpenAIAgent.from_tools(
-        tools,
-        llm=OpenAI(model="gpt-4o",temperature=0.4),
-        system_prompt=system_prompt,
-    )
+    messages = [
+        ChatMessage(role=MessageRole.SYSTEM, content=system_prompt),
+        *text_messages(chat_history),
+        ChatMessage(role=MessageRole.USER, content="""
+            Look at the chat history to date and figure out what the user was originally trying to do.
+            They might have had to do some sub-tasks to complete that task, but what we want is the original thing they started out trying to do.
+            Formulate a sentence as if written by the user that asks to continue that task.
+            If it seems like the user really completed their task, output "no_further_task" only.
+        """),
+    ]
+    response = await meta_llm.achat(messages)
+    return str(response.message.content).strip()
 
 # Orchestration agent
-def orchestration_agent_factory(state: dict) -> OpenAIAgent:
-
-    def has_balance() -> bool:
-        """Useful for checking if an account has a balance."""
-        print("Orchestrator checking if account has a balance")
-        return (state["account_balance"] is not None)
-    
-    def is_authenticated() -> bool:
-        """Checks if the user has a session token."""
-        print("Orchestrator is checking if authenticated")
-        return (state["session_token"] is not None)
+# The routing prompt is built once at import, so every call sends the same bytes.
+ORCHESTRATOR_DESCRIPTIONS = {
+    Speaker.STOCK_LOOKUP: "look up a stock price (no authentication needed)",
+    Speaker.AUTHENTICATE: "log in; also for a balance or transfer while is_authenticated is false",
+    Speaker.ACCOUNT_BALANCE: "check an account balance; also for a transfer while has_balance is false",
+    Speaker.TRANSFER_MONEY: "transfer money between accounts",
+    Speaker.CONCIERGE: "anything else, or if it's unclear what they want. This is the default.",
+}
+
+ORCHESTRATOR_RUBRIC = "\n".join(
+    f'* "{speaker.value}" - {description}' for speaker, description in ORCHESTRATOR_DESCRIPTIONS.items()
+)
+
+ORCHESTRATOR_PROMPT = (
+    "You are an orchestration agent. You pick the agent that should handle the user's latest message.\n"
+    "is_authenticated and has_balance describe the user's current state.\n"
+    "Set agent to the name of one of these agents:\n"
+    + ORCHESTRATOR_RUBRIC
+)
+
+# Structured output: the reply can only be {"agent": <one of the names above>}
+ORCHESTRATOR_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "route",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "agent": {
+                    "type": "string",
+                    "enum": [speaker.value for speaker in ORCHESTRATOR_DESCRIPTIONS],
+                },
+            },
+            "required": ["agent"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+async def orchestrate(state: dict, user_msg_str: str, chat_history: List[ChatMessage]) -> str:
+    """Picks the next speaker with a single LLM call; it doesn't need an agent or tools."""
+
+    # these checks used to be tools the orchestrator had to call, costing a round trip each
+    checks = (
+        f"is_authenticated: {state['session_token'] is not None}\n"
+        f"has_balance: {state['account_balance'] is not None}"
+    )
 
-    tools = [
-        FunctionTool.from_defaults(fn=has_balance),
-        FunctionTool.from_defaults(fn=is_authenticated),
+    # the last few exchanges are enough to tell what the user means; everything
+    # routing needs from the state is in the checks, so state updates are left out
+    recent_history = [
+        message for message in text_messages(chat_history)
+        if message.role != MessageRole.SYSTEM
+    ][-6:]
+
+    messages = [
+        ChatMessage(role=MessageRole.SYSTEM, content=ORCHESTRATOR_PROMPT),
+        *recent_history,
+        ChatMessage(role=MessageRole.SYSTEM, content=checks),
+        ChatMessage(role=MessageRole.USER, content=user_msg_str),
     ]
-    
-    system_prompt = (f"""
-        You are on orchestration agent.
-        Your job is to decide which agent to run based on the current state of the user and what they've asked to do. Agents are identified by short strings.
-        What you do is return the name of the agent to run next. You do not do anything else.
-        
-        The current state of the user is:
-        {pprint.pformat(state, indent=4)}
-
-        If a current_speaker is already selected in the state, simply output that value.
-
-        If there is no current_speaker value, look at the chat history and the current state and you MUST return one of these strings identifying an agent to run:
-        * "{Speaker.STOCK_LOOKUP.value}" - if they user wants to look up a stock price (does not require authentication)
-        * "{Speaker.AUTHENTICATE.value}" - if the user needs to authenticate
-        * "{Speaker.ACCOUNT_BALANCE.value}" - if the user wants to look up an account balance
-            * If they want to look up an account balance, but they haven't authenticated yet, return "{Speaker.AUTHENTICATE.value}" instead
-        * "{Speaker.TRANSFER_MONEY.value}" - if the user wants to transfer money between accounts (requires authentication and checking an account balance first)
-            * If they want to transfer money, but is_authenticated returns false, return "{Speaker.AUTHENTICATE.value}" instead
-            * If they want to transfer money, but has_balance returns false, return "{Speaker.ACCOUNT_BALANCE.value}" instead
-        * "{Speaker.CONCIERGE.value}" - if the user wants to do something else, or hasn't said what they want to do, or you can't figure out what they want to do. Choose this by default.
-
-        Output one of these strings and ONLY these strings, without quotes.
-        NEVER respond with anything other than one of the above five strings. DO NOT be helpful or conversational.
-    """)
-
-    return OpenAIAgent.from_tools(
-        tools,
-        llm=OpenAI(model="gpt-4o",temperature=0.4),
-        system_prompt=system_prompt,
+    # the reply is a handful of tokens, so it's read in full; that also lets the
+    # connection go back to the shared pool
+    response = await meta_llm.achat(
+        messages,
+        response_format=ORCHESTRATOR_RESPONSE_FORMAT,
+        max_tokens=16,
     )
+    try:
+        return json.loads(response.message.content)["agent"]
+    except (TypeError, ValueError, KeyError):
+        # not a known speaker, so run() asks the user to try again
+        return ""
+
+# Speaker agents by the name the orchestration agent returns for them
+speaker_factories = {
+    Speaker.STOCK_LOOKUP: stock_lookup_agent_factory,
+    Speaker.AUTHENTICATE: auth_agent_factory,
+    Speaker.ACCOUNT_BALANCE: account_balance_agent_factory,
+    Speaker.TRANSFER_MONEY: transfer_money_agent_factory,
+    Speaker.CONCIERGE: concierge_agent_factory,
+}
 
 def get_initial_state() -> dict:
     return {
@@ -356,15 +410,37 @@ def get_initial_state() -> dict:
         "just_finished": False,
     }
 
-def run() -> None:
+def state_message(state: dict) -> ChatMessage:
+    """Records the current user state as a message in the chat history."""
+    return ChatMessage(
+        role=MessageRole.SYSTEM,
+        content=f"State update. The current user state is: {json.dumps(state, default=str, separators=(',', ':'))}",
+    )
+
+async def run() -> None:
     state = get_initial_state()
 
-    root_memory = ChatMemoryBuffer.from_defaults(token_limit=8000)
+    # shared by all the speaker agents, which read and append to it directly;
+    # once it passes the token limit, older turns are summarized instead of resent
+    root_memory = ChatSummaryMemoryBuffer.from_defaults(llm=llm, token_limit=8000)
+
+    # built agents, keyed by factory. Their system prompts don't depend on the state,
+    # so one agent per factory serves the whole session; their tools are bound to
+    # this run's state and memory, so the cache lives and dies with the run
+    agents = {}
 
     first_run = True
     is_retry = False
+    recorded_state = None
 
     while True:
+        # the state goes into the history rather than the system prompts, so the
+        # prompts stay identical between calls and OpenAI can cache them
+        if state != recorded_state:
+            root_memory.put(state_message(state))
+            recorded_state = dict(state)
+        current_history = root_memory.get()
+
         if first_run:
             # if this is the first run, start the conversation
             user_msg_str = "Hello"
@@ -374,67 +450,54 @@ def run() -> None:
             is_retry = False
         elif state["just_finished"] == True:
             print("Asking the continuation agent to decide what to do next")
-            user_msg_str = str(continuation_agent_factory(state).chat("""
-                Look at the chat history to date and figure out what the user was originally trying to do.
-                They might have had to do some sub-tasks to complete that task, but what we want is the original thing they started out trying to do.                                                                      
-                Formulate a sentence as if written by the user that asks to continue that task.
-                If it seems like the user really completed their task, output "no_further_task" only.
-            """, chat_history=current_history))
+            user_msg_str = await continue_task(current_history)
             print(f"Continuation agent said {user_msg_str}")
             if user_msg_str == "no_further_task":
                 user_msg_str = input(">> ").strip()
             state["just_finished"] = False
         else:
-            # any other time, get user input
+            # any other time, get user input. A plain blocking read is fine: nothing else
+            # runs while we wait on the user, and Ctrl+C still exits straight away
             user_msg_str = input("> ").strip()            
 
-        current_history = root_memory.get()
-
         # who should speak next?
         if (state["current_speaker"]):
             print(f"There's already a speaker: {state['current_speaker']}")
             next_speaker = state["current_speaker"]
         else:
             print("No current speaker, asking orchestration agent to decide")
-            orchestration_response = orchestration_agent_factory(state).chat(user_msg_str, chat_history=current_history)
-            next_speaker = str(orchestration_response).strip()
+            next_speaker = await orchestrate(state, user_msg_str, current_history)
 
         #print(f"Next speaker: {next_speaker}")
 
-        if next_speaker == Speaker.STOCK_LOOKUP:
-            print("Stock lookup agent selected")
-            current_speaker = stock_lookup_agent_factory(state)
-            state["current_speaker"] = next_speaker
-        elif next_speaker == Speaker.AUTHENTICATE:
-            print("Auth agent selected")
-            current_speaker = auth_agent_factory(state)
-            state["current_speaker"] = next_speaker
-        elif next_speaker == Speaker.ACCOUNT_BALANCE:
-            print("Account balance agent selected")
-            current_speaker = account_balance_agent_factory(state)
-            state["current_speaker"] = next_speaker
-        elif next_speaker == Speaker.TRANSFER_MONEY:
-            print("Transfer money agent selected")
-            current_speaker = transfer_money_agent_factory(state)
-            state["current_speaker"] = next_speaker
-        elif next_speaker == Speaker.CONCIERGE:
-            print("Concierge agent selected")
-            current_speaker = concierge_agent_factory(state)
-        else:
+        factory = speaker_factories.get(next_speaker)
+        if factory is None:
             print("Orchestration agent failed to return a valid speaker; ask it to try again")
             is_retry = True
             continue
 
-        pretty_state = pprint.pformat(state, indent=4)
-        #print(f"State: {pretty_state}")
+        print(f"Agent selected: {next_speaker}")
+        if factory not in agents:
+            agents[factory] = factory(state, root_memory)
+        current_speaker = agents[factory]
+        # the concierge just helps the user pick a task, so it never keeps the floor
+        if next_speaker != Speaker.CONCIERGE:
+            state["current_speaker"] = next_speaker
+
+        #print(f"State: {json.dumps(state, indent=4, default=str)}")
 
-        # chat with the current speaker
-        response = current_speaker.chat(user_msg_str, chat_history=current_history)
-        print(Fore.MAGENTA + str(response) + Style.RESET_ALL)
+        # chat with the current speaker, printing its reply as it streams in
+        response = await current_speaker.astream_chat(user_msg_str)
+        print(Fore.MAGENTA, end="")
+        async for token in response.async_response_gen():
+            print(token, end="", flush=True)
+        print(Style.RESET_ALL)
 
-        # update chat history
-        new_history = current_speaker.memory.get_all()
-        root_memory.set(new_history)
+async def main() -> None:
+    try:
+        await run()
+    finally:
+        await http_client.aclose()
 
 if __name__ == "__main__":
-    run()
+    asyncio.run(main())
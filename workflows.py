@@ -10,13 +10,12 @@ from llama_index.core.workflow import (
     StopEvent
 )
 from llama_index.llms.openai import OpenAI
-from llama_index.llms.anthropic import Anthropic
 from llama_index.core.agent import FunctionCallingAgentWorker
+from llama_index.core.memory import ChatSummaryMemoryBuffer
 from llama_index.core.tools import FunctionTool
-from enum import Enum
+import asyncio
 from typing import Optional, List, Callable
-from llama_index.utils.workflow import draw_all_possible_flows
-from colorama import Fore, Back, Style
+from colorama import Fore, Style
 
 class InitializeEvent(Event):
     pass
@@ -56,13 +55,14 @@ class ConciergeWorkflow(Workflow):
         ctx.data["overall_request"] = None
 
         ctx.data["llm"] = OpenAI(model="gpt-4o",temperature=0.4)
+        #from llama_index.llms.anthropic import Anthropic
         #ctx.data["llm"] = Anthropic(model="claude-3-5-sonnet-20240620",temperature=0.4)
         #ctx.data["llm"] = Anthropic(model="claude-3-opus-20240229",temperature=0.4)
 
         return ConciergeEvent()
   
     @step(pass_context=True)
-    async def concierge(self, ctx: Context, ev: ConciergeEvent | StartEvent) -> InitializeEvent | StopEvent | OrchestratorEvent:
+    async def concierge(self, ctx: Context, ev: ConciergeEvent | StartEvent) -> InitializeEvent | StopEvent | OrchestratorEvent | AccountBalanceEvent | TransferMoneyEvent:
         # initialize user if not already done
         if ("user" not in ctx.data):
             return InitializeEvent()
@@ -86,22 +86,27 @@ class ConciergeWorkflow(Workflow):
                 allow_parallel_tool_calls=False,
                 system_prompt=system_prompt
             )
-            ctx.data["concierge"] = agent_worker.as_agent()        
+            # summarize older turns rather than resending the whole conversation each time
+            ctx.data["concierge"] = agent_worker.as_agent(
+                memory=ChatSummaryMemoryBuffer.from_defaults(llm=ctx.data["llm"], token_limit=4000)
+            )
 
         concierge = ctx.data["concierge"]
         if ctx.data["overall_request"] is not None:
-            print("There's an overall request in progress, it's ", ctx.data["overall_request"])
+            # the agent that redirected us stored the event that resumes it, so there's
+            # nothing for the orchestrator to decide
+            print("There's an overall request in progress, it's ", ctx.data["overall_request"].request)
             last_request = ctx.data["overall_request"]
             ctx.data["overall_request"] = None
-            return OrchestratorEvent(request=last_request)
+            return last_request
         elif (ev.just_completed is not None):
-            response = concierge.chat(f"FYI, the user has just completed the task: {ev.just_completed}")
+            response = await concierge.achat(f"FYI, the user has just completed the task: {ev.just_completed}")
         elif (ev.need_help):
             print("The previous process needs help with ", ev.request)
             return OrchestratorEvent(request=ev.request)
         else:
             # first time experience
-            response = concierge.chat("Hello!")
+            response = await concierge.achat("Hello!")
 
         print(Fore.MAGENTA + str(response) + Style.RESET_ALL)
         user_msg_str = input("> ").strip()
@@ -112,75 +117,85 @@ class ConciergeWorkflow(Workflow):
 
         print(f"Orchestrator received request: {ev.request}")
 
-        def emit_stock_lookup() -> bool:
-            """Call this if the user wants to look up a stock price."""      
-            print("__emitted: stock lookup")      
-            self.send_event(StockLookupEvent(request=ev.request))
-            return True
-
-        def emit_authenticate() -> bool:
-            """Call this if the user wants to authenticate"""
-            print("__emitted: authenticate")
-            self.send_event(AuthenticateEvent(request=ev.request))
-            return True
-
-        def emit_account_balance() -> bool:
-            """Call this if the user wants to check an account balance."""
-            print("__emitted: account balance")
-            self.send_event(AccountBalanceEvent(request=ev.request))
-            return True
-
-        def emit_transfer_money() -> bool:
-            """Call this if the user wants to transfer money."""
-            print("__emitted: transfer money")
-            self.send_event(TransferMoneyEvent(request=ev.request))
-            return True
-
-        def emit_concierge() -> bool:
-            """Call this if the user wants to do something else or you can't figure out what they want to do."""
-            print("__emitted: concierge")
-            self.send_event(ConciergeEvent(request=ev.request))
-            return True
-
-        def emit_stop() -> bool:
-            """Call this if the user wants to stop or exit the system."""
-            print("__emitted: stop")
-            self.send_event(StopEvent())
-            return True
-
-        tools = [
-            FunctionTool.from_defaults(fn=emit_stock_lookup),
-            FunctionTool.from_defaults(fn=emit_authenticate),
-            FunctionTool.from_defaults(fn=emit_account_balance),
-            FunctionTool.from_defaults(fn=emit_transfer_money),
-            FunctionTool.from_defaults(fn=emit_concierge),
-            FunctionTool.from_defaults(fn=emit_stop)
-        ]
+        # built once; the emit tools record the chosen route in ctx.data, and the
+        # step returns it after the agent has finished
+        if ("orchestrator" not in ctx.data):
+            def emit_stock_lookup() -> bool:
+                """Call this if the user wants to look up a stock price."""      
+                print("__emitted: stock lookup")      
+                ctx.data["orchestrator_route"] = StockLookupEvent(request=ctx.data["orchestrator_request"])
+                return True
+
+            def emit_authenticate() -> bool:
+                """Call this if the user wants to authenticate"""
+                print("__emitted: authenticate")
+                ctx.data["orchestrator_route"] = AuthenticateEvent(request=ctx.data["orchestrator_request"])
+                return True
+
+            def emit_account_balance() -> bool:
+                """Call this if the user wants to check an account balance."""
+                print("__emitted: account balance")
+                ctx.data["orchestrator_route"] = AccountBalanceEvent(request=ctx.data["orchestrator_request"])
+                return True
+
+            def emit_transfer_money() -> bool:
+                """Call this if the user wants to transfer money."""
+                print("__emitted: transfer money")
+                ctx.data["orchestrator_route"] = TransferMoneyEvent(request=ctx.data["orchestrator_request"])
+                return True
+
+            def emit_concierge() -> bool:
+                """Call this if the user wants to do something else or you can't figure out what they want to do."""
+                print("__emitted: concierge")
+                ctx.data["orchestrator_route"] = ConciergeEvent(request=ctx.data["orchestrator_request"])
+                return True
+
+            def emit_stop() -> bool:
+                """Call this if the user wants to stop or exit the system."""
+                print("__emitted: stop")
+                ctx.data["orchestrator_route"] = StopEvent()
+                return True
+
+            tools = [
+                FunctionTool.from_defaults(fn=emit_stock_lookup),
+                FunctionTool.from_defaults(fn=emit_authenticate),
+                FunctionTool.from_defaults(fn=emit_account_balance),
+                FunctionTool.from_defaults(fn=emit_transfer_money),
+                FunctionTool.from_defaults(fn=emit_concierge),
+                FunctionTool.from_defaults(fn=emit_stop)
+            ]
         
-        system_prompt = (f"""
-            You are on orchestration agent.
-            Your job is to decide which agent to run based on the current state of the user and what they've asked to do. 
-            You run an agent by calling the appropriate tool for that agent.
-            You do not need to call more than one tool.
-            You do not need to figure out dependencies between agents; the agents will handle that themselves.
+            system_prompt = (f"""
+                You are on orchestration agent.
+                Your job is to decide which agent to run based on the current state of the user and what they've asked to do. 
+                You run an agent by calling the appropriate tool for that agent.
+                You do not need to call more than one tool.
+                You do not need to figure out dependencies between agents; the agents will handle that themselves.
                             
-            If you did not call any tools, return the string "FAILED" without quotes and nothing else.
-        """)
+                If you did not call any tools, return the string "FAILED" without quotes and nothing else.
+            """)
 
-        agent_worker = FunctionCallingAgentWorker.from_tools(
-            tools=tools,
-            llm=ctx.data["llm"],
-            allow_parallel_tool_calls=False,
-            system_prompt=system_prompt
-        )
-        ctx.data["orchestrator"] = agent_worker.as_agent()        
-        
+            agent_worker = FunctionCallingAgentWorker.from_tools(
+                tools=tools,
+                llm=ctx.data["llm"],
+                allow_parallel_tool_calls=False,
+                system_prompt=system_prompt
+            )
+            ctx.data["orchestrator"] = agent_worker.as_agent()        
+
+        ctx.data["orchestrator_request"] = ev.request
+        ctx.data["orchestrator_route"] = None
         orchestrator = ctx.data["orchestrator"]
-        response = str(orchestrator.chat(ev.request))
+        # each routing decision stands alone, as it did when the agent was rebuilt per request
+        orchestrator.reset()
+        response = str(await orchestrator.achat(ev.request))
 
-        if response == "FAILED":
+        # the agent answers "FAILED" when it calls no tool, which leaves no route
+        if response == "FAILED" or ctx.data["orchestrator_route"] is None:
             print("Orchestration agent failed to return a valid speaker; try again")
             return OrchestratorEvent(request=ev.request)
+
+        return ctx.data["orchestrator_route"]
         
     @step(pass_context=True)
     async def stock_lookup(self, ctx: Context, ev: StockLookupEvent) -> ConciergeEvent:
@@ -216,7 +231,7 @@ class ConciergeWorkflow(Workflow):
                 trigger_event=StockLookupEvent
             )
 
-        return ctx.data["stock_lookup_agent"].handle_event(ev)
+        return await ctx.data["stock_lookup_agent"].handle_event(ev)
 
     @step(pass_context=True)
     async def authenticate(self, ctx: Context, ev: AuthenticateEvent) -> ConciergeEvent:
@@ -258,10 +273,10 @@ class ConciergeWorkflow(Workflow):
                 trigger_event=AuthenticateEvent
             )
 
-        return ctx.data["authentication_agent"].handle_event(ev)
+        return await ctx.data["authentication_agent"].handle_event(ev)
     
     @step(pass_context=True)
-    def account_balance(self, ctx: Context, ev: AccountBalanceEvent) -> AuthenticateEvent | ConciergeEvent:
+    async def account_balance(self, ctx: Context, ev: AccountBalanceEvent) -> AuthenticateEvent | ConciergeEvent:
         
         if("account_balance_agent" not in ctx.data):
             def get_account_id(account_name: str) -> str:
@@ -288,9 +303,8 @@ class ConciergeWorkflow(Workflow):
             def authenticate() -> None:
                 """Call this if the user needs to authenticate."""
                 print("Account balance agent is authenticating")
-                ctx.data["redirecting"] = True
-                ctx.data["overall_request"] = "Check account balance"
-                self.send_event(AuthenticateEvent(request="Authenticate"))
+                ctx.data["overall_request"] = AccountBalanceEvent(request="Check account balance")
+                ctx.data["redirecting"] = AuthenticateEvent(request="Authenticate")
 
             system_prompt = (f"""
                 You are a helpful assistant that is looking up account balances.
@@ -315,10 +329,10 @@ class ConciergeWorkflow(Workflow):
         # TODO: this could programmatically check for authentication and emit an event
         # but then the agent wouldn't say anything helpful about what's going on.
 
-        return ctx.data["account_balance_agent"].handle_event(ev)
+        return await ctx.data["account_balance_agent"].handle_event(ev)
     
     @step(pass_context=True)
-    def transfer_money(self, ctx: Context, ev: TransferMoneyEvent) -> AuthenticateEvent | AccountBalanceEvent | ConciergeEvent:
+    async def transfer_money(self, ctx: Context, ev: TransferMoneyEvent) -> AuthenticateEvent | AccountBalanceEvent | ConciergeEvent:
 
         if("transfer_money_agent" not in ctx.data):
             def transfer_money(from_account_id: str, to_account_id: str, amount: int) -> None:
@@ -353,16 +367,14 @@ class ConciergeWorkflow(Workflow):
             def authenticate() -> None:
                 """Call this if the user needs to authenticate."""
                 print("Account balance agent is authenticating")
-                ctx.data["redirecting"] = True
-                ctx.data["overall_request"] = "Transfer money"
-                self.send_event(AuthenticateEvent(request="Authenticate"))
+                ctx.data["overall_request"] = TransferMoneyEvent(request="Transfer money")
+                ctx.data["redirecting"] = AuthenticateEvent(request="Authenticate")
 
             def check_balance() -> None:
                 """Call this if the user needs to check their account balance."""
                 print("Transfer money agent is checking balance")
-                ctx.data["redirecting"] = True
-                ctx.data["overall_request"] = "Transfer money"
-                self.send_event(AccountBalanceEvent(request="Check balance"))
+                ctx.data["overall_request"] = TransferMoneyEvent(request="Transfer money")
+                ctx.data["redirecting"] = AccountBalanceEvent(request="Check balance")
             
             system_prompt = (f"""
                 You are a helpful assistant that transfers money between accounts.
@@ -383,7 +395,7 @@ class ConciergeWorkflow(Workflow):
                 trigger_event=TransferMoneyEvent
             )
 
-        return ctx.data["transfer_money_agent"].handle_event(ev)
+        return await ctx.data["transfer_money_agent"].handle_event(ev)
 
 class ConciergeAgent():
     name: str
@@ -407,21 +419,20 @@ class ConciergeAgent():
         self.parent = parent
         self.context = context
         self.system_prompt = system_prompt
-        self.context.data["redirecting"] = False
         self.trigger_event = trigger_event
 
-        # set up the tools including the ones everybody gets
+        # set up the tools including the ones everybody gets.
+        # Tools only record where to go next in ctx.data["redirecting"]; handle_event
+        # returns that event once the agent has finished its reply.
         def done() -> None:
             """When you complete your task, call this tool."""
             print(f"{self.name} is complete")
-            self.context.data["redirecting"] = True
-            parent.send_event(ConciergeEvent(just_completed=self.name))
+            self.context.data["redirecting"] = ConciergeEvent(just_completed=self.name)
 
         def need_help() -> None:
             """If the user asks to do something you don't know how to do, call this."""
             print(f"{self.name} needs help")
-            self.context.data["redirecting"] = True
-            parent.send_event(ConciergeEvent(request=self.current_event.request,need_help=True))
+            self.context.data["redirecting"] = ConciergeEvent(request=self.current_event.request,need_help=True)
 
         self.tools = [
             FunctionTool.from_defaults(fn=done),
@@ -436,30 +447,34 @@ class ConciergeAgent():
             allow_parallel_tool_calls=False,
             system_prompt=self.system_prompt
         )
-        self.agent = agent_worker.as_agent()        
+        self.agent = agent_worker.as_agent(
+            memory=ChatSummaryMemoryBuffer.from_defaults(llm=self.context.data["llm"], token_limit=4000)
+        )        
 
-    def handle_event(self, ev: Event):
+    async def handle_event(self, ev: Event):
         self.current_event = ev
 
-        response = str(self.agent.chat(ev.request))
+        response = str(await self.agent.achat(ev.request))
         print(Fore.MAGENTA + str(response) + Style.RESET_ALL)
 
         # if they're sending us elsewhere we're done here
-        if self.context.data["redirecting"]:
-            self.context.data["redirecting"] = False
-            return None
+        next_event = self.context.data["redirecting"]
+        if next_event is not None:
+            self.context.data["redirecting"] = None
+            return next_event
 
         # otherwise, get some user input and then loop
         user_msg_str = input("> ").strip()
         return self.trigger_event(request=user_msg_str)
 
-draw_all_possible_flows(ConciergeWorkflow,filename="concierge_flows.html")
-
 async def main():
+    # imported here so that importing this module doesn't pull in the drawing dependencies
+    from llama_index.utils.workflow import draw_all_possible_flows
+    draw_all_possible_flows(ConciergeWorkflow,filename="concierge_flows.html")
+
     c = ConciergeWorkflow(timeout=1200, verbose=True)
     result = await c.run()
     print(result)
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())